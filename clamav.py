@@ -6,6 +6,11 @@ from PyQt5.QtGui import QFont, QIcon
 import sys
 import uuid
 import subprocess
+import threading
+import tempfile
+import queue
+import time
+import math
 import requests
 import os
 import shutil
@@ -16,6 +21,24 @@ unique_id = str(uuid.uuid4())
 QUARANTINE_FOLDER = os.path.join(os.path.expanduser("~"), "antiv_quarantine")
 SCHEDULE_FILE = os.path.join(os.path.expanduser("~"), "antiv_schedule.json")
 
+# Number of parallel clamscan workers per device
+ROTATIONAL_SCAN_WORKERS = 1
+SSD_SCAN_WORKERS = 4
+DEFAULT_SCAN_WORKERS = 2
+MIN_FILES_PER_WORKER = 500  # below this a worker spends most of its time loading signatures
+CLAMSCAN_MEMORY = 1024 * 1024 * 1024  # rough size of one clamscan with the signature database loaded
+
+# Summary lines that are added up across clamscan runs
+SUMMED_SUMMARY_FIELDS = ["Scanned directories", "Scanned files", "Infected files", "Total errors"]
+SIZE_SUMMARY_FIELDS = ["Data scanned", "Data read"]
+SIZE_UNITS = {"B": 1 / (1024 * 1024), "KB": 1 / 1024, "KiB": 1 / 1024, "MB": 1, "MiB": 1, "GB": 1024, "GiB": 1024}
+
+# Files above LARGE_FILE_SIZE are scanned after the others, in a clamscan run with raised limits
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+MAX_FILE_SIZE = 4000 * 1024 * 1024  # clamscan can't scan more than 4000M of a single file
+MAX_FILE_SCAN_TIME = 300  # seconds
+DATABASE_LOAD_TIME = 120  # seconds, extra allowance for the first file of every clamscan run
+
 
 class ScheduleDialog(QDialog):
     def __init__(self, parent=None):
@@ -167,26 +190,233 @@ class ScheduleDialog(QDialog):
 
 class ScanThread(QThread):
     update_progress = pyqtSignal(int, str)
+    file_status = pyqtSignal(str, str)
     finished_scan = pyqtSignal(str, str)
     virus_found = pyqtSignal(str)
     stop_requested = pyqtSignal()
 
     def __init__(self, scan_path):
         super().__init__()
-        self.scan_path = scan_path
+        # A single path or a list of paths, e.g. several drives at once
+        self.scan_paths = [scan_path] if isinstance(scan_path, str) else list(scan_path)
         self._stop = False
+        self._processes = []
+        self._lock = threading.Lock()
 
     def run(self):
-        files_to_scan = []
-        for root, dirs, files in os.walk(self.scan_path):
-            for file in files:
-                files_to_scan.append(os.path.join(root, file))
+        scan_started = time.monotonic()
+        files_by_device = self.group_files_by_device()
 
-        total_files = len(files_to_scan)
+        total_files = sum(len(files) for files in files_by_device.values())
         if total_files == 0:
             self.finished_scan.emit("No files found to scan.", "")
             return
 
+        workers_by_device = {}
+        for device, files in files_by_device.items():
+            workers_by_device[device] = min(self.get_device_workers(device),
+                                            math.ceil(len(files) / MIN_FILES_PER_WORKER))
+
+        # Every worker is a clamscan with its own signature database, so take workers away
+        # from the busiest devices until the whole scan fits the machine
+        max_processes = self.get_max_scan_processes()
+        while sum(workers_by_device.values()) > max_processes:
+            device = max(workers_by_device, key=workers_by_device.get)
+            if workers_by_device[device] == 1:
+                break
+            workers_by_device[device] -= 1
+
+        # Split each device's files between its own workers so every disk is read in parallel
+        batches = []
+        for device, files in files_by_device.items():
+            small_files, large_files = self.split_large_files(files)
+            workers = workers_by_device[device]
+            for i in range(workers):
+                batches.append((small_files[i::workers], large_files[i::workers]))
+
+        # With more devices than processes left, devices have to share a worker
+        for i in range(max_processes, len(batches)):
+            batches[i % max_processes][0].extend(batches[i][0])
+            batches[i % max_processes][1].extend(batches[i][1])
+        batches = batches[:max_processes]
+
+        results = queue.Queue()
+        for index, (small_files, large_files) in enumerate(batches):
+            threading.Thread(target=self.scan_batch, args=(index, small_files, large_files, results),
+                             daemon=True).start()
+
+        scanned_files = 0
+        infected_files = 0
+        skipped_files = 0
+        errors = 0
+        summaries = []
+        in_progress = {}  # large file -> fraction already read by clamscan
+        pending = len(batches)
+
+        while pending:
+            if self._stop:
+                self.terminate_processes()
+                self.finished_scan.emit("Scan stopped.", "")
+                return
+
+            try:
+                index, kind, payload = results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            if kind == 'done':
+                pending -= 1
+            elif kind == 'summary':
+                summaries.append(payload)
+            elif kind == 'bytes':
+                # Move the bar by the part of a large file clamscan has read so it doesn't stall
+                file_path, fraction = payload
+                in_progress[file_path] = fraction
+                percent_done = self.get_percent_done(scanned_files + skipped_files, in_progress, total_files)
+                self.update_progress.emit(percent_done, "")
+                self.file_status.emit(file_path, f"{int(fraction * 100)}%")
+            elif kind == 'status':
+                file_path, seconds = payload
+                self.file_status.emit(file_path, f"{seconds} s")
+            elif kind == 'found':
+                scanned_files += 1
+                infected_files += 1
+                in_progress.pop(payload.rpartition(': ')[0], None)
+                percent_done = self.get_percent_done(scanned_files + skipped_files, in_progress, total_files)
+                self.update_progress.emit(percent_done, payload)
+                self.virus_found.emit(payload)
+            elif kind == 'ok':
+                scanned_files += 1
+                in_progress.pop(payload.rpartition(': ')[0], None)
+                percent_done = self.get_percent_done(scanned_files + skipped_files, in_progress, total_files)
+                self.update_progress.emit(percent_done, payload)
+            elif kind == 'skipped':
+                file_path, reason = payload
+                skipped_files += 1
+                in_progress.pop(file_path, None)
+                percent_done = self.get_percent_done(scanned_files + skipped_files, in_progress, total_files)
+                self.update_progress.emit(percent_done, f"{file_path}: Skipped ({reason})")
+            elif kind == 'error':
+                errors += 1
+                percent_done = self.get_percent_done(scanned_files + skipped_files, in_progress, total_files)
+                self.update_progress.emit(percent_done, payload)
+
+        final_summary = self.merge_summaries(summaries, scanned_files, infected_files, skipped_files,
+                                             time.monotonic() - scan_started)
+        message = f"Scan complete: {scanned_files} of {total_files} files scanned."
+        if skipped_files:
+            message += f" {skipped_files} skipped (too large or timed out)."
+        if errors:
+            message += f" {errors} errors, see the log above."
+        self.finished_scan.emit(message, final_summary)
+
+    def get_percent_done(self, finished_files, in_progress, total_files):
+        return int(((finished_files + sum(in_progress.values())) / total_files) * 100)
+
+    def merge_summaries(self, summaries, scanned_files, infected_files, skipped_files, elapsed):
+        # Every clamscan run prints a summary of its own part of the scan, add them up into one
+        merged = {}
+        for summary in summaries:
+            for line in summary[1:]:
+                key, _, value = line.partition(': ')
+                if not value:
+                    continue
+                if key in SUMMED_SUMMARY_FIELDS and value.isdigit():
+                    merged[key] = merged.get(key, 0) + int(value)
+                elif key in SIZE_SUMMARY_FIELDS:
+                    merged[key] = merged.get(key, 0) + self.parse_size(value)
+                elif key == "Start Date":
+                    merged[key] = min(merged.get(key, value), value)
+                elif key == "End Date":
+                    merged[key] = max(merged.get(key, value), value)
+                else:
+                    merged.setdefault(key, value)
+
+        if not merged and not scanned_files and not skipped_files:
+            return ""
+
+        # A run killed by the watchdog never prints its summary, so count files from the results instead
+        merged["Scanned files"] = scanned_files
+        merged["Infected files"] = infected_files
+        merged["Time"] = f"{elapsed:.3f} sec ({int(elapsed // 60)} m {int(elapsed % 60)} s)"
+        merged["Skipped files"] = skipped_files
+
+        lines = ["----------- SCAN SUMMARY -----------"]
+        for key, value in merged.items():
+            if key in SIZE_SUMMARY_FIELDS:
+                value = f"{value:.2f} MB"
+            lines.append(f"{key}: {value}")
+        return "\n".join(lines)
+
+    def parse_size(self, value):
+        # e.g. "12.34 MB" or "1.20 MiB (ratio 2.00:1)"
+        number, _, unit = value.split(' (')[0].partition(' ')
+        try:
+            return float(number) * SIZE_UNITS.get(unit, 1)
+        except ValueError:
+            return 0
+
+    def group_files_by_device(self):
+        files_by_device = {}
+        for scan_path in self.scan_paths:
+            for root, dirs, files in os.walk(scan_path):
+                if not files:
+                    continue
+                try:
+                    device = os.stat(root).st_dev
+                except OSError:
+                    continue
+                files_by_device.setdefault(device, []).extend(os.path.join(root, file) for file in files)
+        return files_by_device
+
+    def split_large_files(self, files):
+        small_files = []
+        large_files = []
+        for file_path in files:
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = 0
+            if size > LARGE_FILE_SIZE:
+                large_files.append((file_path, size))
+            else:
+                small_files.append(file_path)
+        return small_files, large_files
+
+    def get_device_workers(self, device):
+        # Linux reports the disk type in /sys/block, other platforms get a middle value
+        if not sys.platform.startswith('linux'):
+            return DEFAULT_SCAN_WORKERS
+
+        block_path = os.path.realpath(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}")
+        # Partitions don't have a queue of their own, it lives on the parent disk
+        for path in [block_path, os.path.dirname(block_path)]:
+            rotational_file = os.path.join(path, "queue", "rotational")
+            if os.path.exists(rotational_file):
+                try:
+                    with open(rotational_file, 'r') as f:
+                        rotational = f.read().strip() == "1"
+                except OSError:
+                    break
+                return ROTATIONAL_SCAN_WORKERS if rotational else SSD_SCAN_WORKERS
+        return DEFAULT_SCAN_WORKERS
+
+    def get_max_scan_processes(self):
+        max_processes = os.cpu_count() or 1
+        # Linux tells how much memory is free, elsewhere only the CPU count is used
+        if os.path.exists("/proc/meminfo"):
+            try:
+                with open("/proc/meminfo", 'r') as f:
+                    for line in f:
+                        if line.startswith("MemAvailable:"):
+                            available = int(line.split()[1]) * 1024
+                            max_processes = min(max_processes, available // CLAMSCAN_MEMORY)
+                            break
+            except (OSError, ValueError):
+                pass
+        return max(1, max_processes)
+
+    def start_clamscan(self, args):
         # Create startupinfo to hide console
         startupinfo = None
         if os.name == 'nt':  # Windows
@@ -194,43 +424,186 @@ class ScanThread(QThread):
             startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
             startupinfo.wShowWindow = subprocess.SW_HIDE
 
-        scanned_files = 0
         clamscan_process = subprocess.Popen(
-            ['clamscan', '-r', self.scan_path],
+            ['clamscan'] + args,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             startupinfo=startupinfo,
             creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
         )
-
-        final_summary = ""
-        scanning_started = False
-
-        for line in clamscan_process.stdout:
+        with self._lock:
+            self._processes.append(clamscan_process)
+            # The scan may have been stopped while this process was starting
             if self._stop:
                 clamscan_process.terminate()
-                self.finished_scan.emit("Scan stopped.", "")
-                return
+        return clamscan_process
 
-            decoded_line = line.decode('utf-8')
+    def scan_batch(self, index, small_files, large_files, results):
+        try:
+            if small_files:
+                self.run_clamscan(index, small_files, [], results)
 
-            if "FOUND" in decoded_line:
-                self.virus_found.emit(decoded_line.strip())
+            scannable_files = []
+            for file_path, size in large_files:
+                if size > MAX_FILE_SIZE:
+                    results.put((index, 'skipped', (file_path, "too large")))
+                else:
+                    scannable_files.append(file_path)
 
-            if "----------- SCAN SUMMARY -----------" in decoded_line:
-                final_summary = decoded_line.strip()
-                scanning_started = True
+            # Only large files get the raised limits, small archives keep clamscan's defaults
+            if scannable_files and not self._stop:
+                limits = [f'--max-filesize={MAX_FILE_SIZE // (1024 * 1024)}M',
+                          f'--max-scansize={MAX_FILE_SIZE // (1024 * 1024)}M']
+                self.run_clamscan(index, scannable_files, limits, results, report_status=True)
+        except Exception as e:
+            results.put((index, 'error', f"Error running clamscan: {str(e)}"))
+        finally:
+            results.put((index, 'done', None))
 
-            if scanning_started:
-                final_summary += "\n" + decoded_line.strip()
+    def run_clamscan(self, index, files, args, results, report_status=False):
+        position = 0
+        while position < len(files) and not self._stop:
+            remaining_files = files[position:]
+            file_positions = {file_path: i for i, file_path in enumerate(remaining_files)}
 
-            if "OK" in decoded_line:
-                scanned_files += 1
-                percent_done = int((scanned_files / total_files) * 100)
-                self.update_progress.emit(percent_done, decoded_line.strip())
+            with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as file_list:
+                file_list.write("\n".join(remaining_files))
 
-        clamscan_process.wait()
-        self.finished_scan.emit(f"Scan complete: {scanned_files} of {total_files} files scanned.", final_summary)
+            try:
+                clamscan_process = self.start_clamscan(args + [f'--file-list={file_list.name}'])
+                lines = queue.Queue()
+                threading.Thread(target=self.read_lines, args=(clamscan_process, lines), daemon=True).start()
+
+                # clamscan works through the list in order, so the current file is the one after the last result
+                finished = 0
+                file_started = time.monotonic()
+                last_report = file_started
+                read_start = self.get_read_bytes(clamscan_process.pid)
+                budget = MAX_FILE_SCAN_TIME + DATABASE_LOAD_TIME
+                timed_out = False
+                reported_error = False
+                summary = None
+
+                while True:
+                    if self._stop:
+                        return
+
+                    # Checked on every line too, a file that keeps printing warnings must still time out
+                    elapsed = time.monotonic() - file_started
+                    if finished < len(remaining_files) and elapsed > budget:
+                        clamscan_process.kill()
+                        clamscan_process.wait()
+                        results.put((index, 'skipped', (remaining_files[finished], "timeout")))
+                        timed_out = True
+                        break
+
+                    if report_status and finished < len(remaining_files) and time.monotonic() - last_report >= 0.5:
+                        last_report = time.monotonic()
+                        file_path = remaining_files[finished]
+                        fraction = self.get_read_fraction(clamscan_process.pid, file_path, read_start)
+                        if fraction is None:
+                            results.put((index, 'status', (file_path, int(elapsed))))
+                        else:
+                            results.put((index, 'bytes', (file_path, fraction)))
+
+                    try:
+                        line = lines.get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+
+                    if line is None:
+                        break
+
+                    decoded_line = line.decode('utf-8', errors='replace').strip()
+
+                    is_error = decoded_line.lower().startswith(("error", "libclamav error"))
+
+                    if "----------- SCAN SUMMARY -----------" in decoded_line:
+                        summary = []
+                    if summary is not None and not is_error:
+                        summary.append(decoded_line)
+                        continue
+
+                    file_path, _, verdict = decoded_line.rpartition(': ')
+                    if file_path in file_positions:
+                        finished = max(finished, file_positions[file_path] + 1)
+                        file_started = time.monotonic()
+                        budget = MAX_FILE_SCAN_TIME
+                        read_start = self.get_read_bytes(clamscan_process.pid)
+
+                    if verdict == "OK":
+                        results.put((index, 'ok', decoded_line))
+                    elif verdict.endswith("FOUND"):
+                        results.put((index, 'found', decoded_line))
+                    elif verdict.endswith("ERROR") or is_error:
+                        results.put((index, 'error', decoded_line))
+                        reported_error = True
+
+                # clamscan exits with 2 when something went wrong
+                if clamscan_process.wait() == 2 and not timed_out and not reported_error:
+                    results.put((index, 'error', "clamscan exited with an error"))
+            finally:
+                os.remove(file_list.name)
+
+            if summary:
+                results.put((index, 'summary', summary))
+
+            # After a timeout, start a new run from the file after the one that hung
+            position += finished + 1 if timed_out else len(remaining_files)
+
+    def get_read_bytes(self, pid):
+        # Bytes the process has pulled from disk, mmap page faults included (Linux only)
+        try:
+            with open(f"/proc/{pid}/io", 'r') as f:
+                for line in f:
+                    if line.startswith("read_bytes:"):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def get_read_fraction(self, pid, file_path, read_start):
+        # Linux only: how much of file_path clamscan has read, from the offset of its open
+        # descriptor or, for mmap'ed files, from the bytes read off disk since the file started
+        try:
+            size = os.path.getsize(file_path)
+            real_path = os.path.realpath(file_path)
+            fd_dir = f"/proc/{pid}/fd"
+            fds = os.listdir(fd_dir)
+        except OSError:
+            return None
+
+        offset = 0
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)) != real_path:
+                    continue
+                with open(f"/proc/{pid}/fdinfo/{fd}", 'r') as f:
+                    for line in f:
+                        if line.startswith("pos:"):
+                            offset = max(offset, int(line.split()[1]))
+            except (OSError, ValueError):
+                continue
+
+        read_bytes = self.get_read_bytes(pid)
+        if read_bytes is not None and read_start is not None:
+            offset = max(offset, read_bytes - read_start)
+
+        if size == 0:
+            return None
+        # Never report a file as done before clamscan prints its verdict
+        return min(offset / size, 0.99)
+
+    def read_lines(self, process, lines):
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def terminate_processes(self):
+        with self._lock:
+            for process in self._processes:
+                if process.poll() is None:
+                    process.terminate()
 
     def stop_scan(self):
         self._stop = True
@@ -573,9 +946,10 @@ class ClamavApp(QMainWindow):
 
         self.drive_list_widget = QListWidget()
         self.drive_list_widget.addItems(drive_list)
+        self.drive_list_widget.setSelectionMode(QListWidget.ExtendedSelection)
         layout.addWidget(self.drive_list_widget)
 
-        select_button = QPushButton('Select Drive')
+        select_button = QPushButton('Scan Selected Drives')
         select_button.clicked.connect(self.start_scan_on_selected_drive)
         layout.addWidget(select_button)
 
@@ -601,7 +975,8 @@ class ClamavApp(QMainWindow):
     def start_scan_on_selected_drive(self):
         selected_items = self.drive_list_widget.selectedItems()
         if selected_items:
-            self.selected_drive = selected_items[0].text()
+            drives = [item.text() for item in selected_items]
+            self.selected_drive = drives[0] if len(drives) == 1 else drives
             self.scan_path = self.selected_drive
             self.start_scan()
             self.drive_selection_window.close()
@@ -619,6 +994,7 @@ class ClamavApp(QMainWindow):
 
         self.scan_thread = ScanThread(self.scan_path)
         self.scan_thread.update_progress.connect(self.update_progress)
+        self.scan_thread.file_status.connect(self.update_file_status)
         self.scan_thread.finished_scan.connect(self.on_scan_finished)
         self.scan_thread.virus_found.connect(self.handle_virus_found)
         self.scan_thread.stop_requested.connect(self.on_stop_scan)
@@ -637,9 +1013,13 @@ class ClamavApp(QMainWindow):
 
     def update_progress(self, percent_done, message):
         self.progress_bar.setValue(percent_done)
-        self.textbox.append(message)
+        if message:
+            self.textbox.append(message)
         self.status_label.setText(f"Scanning... {percent_done}%")
 
+    def update_file_status(self, file_path, detail):
+        self.status_label.setText(f"Scanning... {self.progress_bar.value()}% ({os.path.basename(file_path)}, {detail})")
+
     def on_scan_finished(self, message, summary):
         self.scan_btn.setEnabled(True)
         self.stop_btn.setEnabled(False)